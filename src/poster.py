@@ -1,20 +1,29 @@
 # src/poster.py
 import os
 import json
+import mmap
+import time
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
-import pytz
-import tweepy
 
+__all__ = ["main"]
 
 ROOT = Path(__file__).resolve().parent.parent
 DATA_DIR = ROOT / "data"
 STATE_PATH = ROOT / "src" / "state.json"
 TWEETS_PATH = DATA_DIR / "tweets.txt"
+TWEETS_INDEX_PATH = DATA_DIR / "tweets.txt.idx"
+OFFSET_SIZE = array("q").itemsize  # indeks kaydı başına bayt (int64)
+INDEX_HEADER = 2  # indeks başındaki kayıt sayısı: kaynağın (st_mtime_ns, st_size)
 HOURS_PATH = DATA_DIR / "hours.txt"
 
-TZ = pytz.timezone("Europe/Istanbul")
+# Tek seferlik çözümlenir; ZoneInfo kendi önbelleğini tutar.
+TZ = ZoneInfo("Europe/Istanbul")
 
 
 def env_bool(name: str, default: bool = False) -> bool:
@@ -28,28 +37,144 @@ def load_state():
     if STATE_PATH.exists():
         try:
             with open(STATE_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
+                state = json.load(f)
+            # Eski şema (last_posted_index) ile yazılmış state'i next_index'e taşı.
+            # Eski kod şablondaki "next_index": 0'ı da geri yazdığı için last_posted_index esas alınır.
+            if "last_posted_index" in state:
+                state["next_index"] = int(state.pop("last_posted_index")) + 1
+            return state
         except Exception:
             pass
-    # İlk kez: son atılan index yok => -1
+    # İlk kez: sıradaki tweet ilk satır
     return {
-        "last_posted_index": -1,
+        "next_index": 0,
         "last_posted_iso": None,
     }
 
 
+def record_post(state, index: int, now: datetime, slot=None):
+    """index numaralı tweet'i (ve varsa karşıladığı slotu) tüketilmiş say; kaydetmez."""
+    state["next_index"] = index + 1
+    state["last_posted_iso"] = now.isoformat()  # sadece okunabilirlik için
+    state["last_posted_epoch_min"] = epoch_minute(now)
+    if slot is not None:
+        state["last_slot_epoch_min"] = slot
+
+
+def epoch_minute(dt: datetime) -> int:
+    return int(dt.timestamp()) // 60
+
+
+def already_posted_this_minute(state, now: datetime) -> bool:
+    # Tek tamsayı karşılaştırması; ISO string'i parse etmeye gerek yok
+    return state.get("last_posted_epoch_min") == epoch_minute(now)
+
+
 def save_state(state):
+    # Önce geçici dosyaya yaz, sonra atomik olarak yerine koy: yarıda kesilirse eski state kalır.
     STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    # orjson sadece kayıt gerektiğinde yüklenir; planlı olmayan tick'ler import maliyetini ödemez
+    try:
+        import orjson
+    except ImportError:  # opsiyonel hızlandırıcı; yoksa stdlib json kullanılır
+        data = json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    else:
+        data = orjson.dumps(state)
+    tmp = STATE_PATH.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, STATE_PATH)
 
 
 def load_lines(path: Path):
     if not path.exists():
         raise FileNotFoundError(f"Bulunamadı: {path}")
     with open(path, "r", encoding="utf-8") as f:
-        # boş satırları ayıkla
-        return [ln.strip() for ln in f.readlines() if ln.strip()]
+        # tek geçiş: her satır bir kez strip edilir, boş satırlar ayıklanır
+        return [s for s in (ln.strip() for ln in f) if s]
+
+
+# path -> ((st_mtime_ns, st_size), ayrıştırılmış sonuç)
+_CACHE = {}
+
+
+def load_cached(path: Path, parser):
+    """
+    parser(path) sonucunu dosyanın (mtime_ns, size) anahtarıyla önbellekler.
+    Dosya değişmediyse sadece bir os.stat çağrısı yapılır (LOOP_SECONDS modu için).
+    Sonucu başka dosyalara da bağlı olan ayrıştırmalar (ör. tweets.txt indeksi) için kullanılmamalı.
+    """
+    key = source_key(path)
+    cached = _CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    parsed = parser(path)
+    _CACHE[path] = (key, parsed)
+    return parsed
+
+
+def source_key(path: Path):
+    """Dosyanın (st_mtime_ns, st_size) anahtarı; önbellek ve indeks tazeliği için ortak kural."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Bulunamadı: {path}") from None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def read_index_key(idx_path: Path):
+    # İndeks başlığındaki kaynak anahtarı; indeks yoksa/bozuksa None
+    header = array("q")
+    try:
+        with open(idx_path, "rb") as f:
+            header.fromfile(f, INDEX_HEADER)
+    except (OSError, EOFError):
+        return None
+    return tuple(header)
+
+
+def build_index(path: Path, idx_path: Path, key=None) -> Path:
+    """
+    Başlıkta kaynağın (mtime_ns, size) anahtarı, ardından dolu satırların başlangıç
+    ofsetleri (int64) ve sonda dosya boyu olan yan dosyayı yazar.
+    Başlık kaynağın güncel anahtarıyla aynıysa mevcut indeks olduğu gibi kullanılır.
+    """
+    if key is None:
+        key = source_key(path)
+    if read_index_key(idx_path) == tuple(key):
+        return idx_path
+
+    offsets = array("q", key)
+    pos = 0
+    with open(path, "rb") as f:
+        for ln in f:
+            if ln.decode("utf-8").strip():
+                offsets.append(pos)
+            pos += len(ln)
+    offsets.append(pos)
+    # state.json gibi: geçici dosyaya yaz, sonra atomik olarak yerine koy
+    tmp = idx_path.with_suffix(".idx.tmp")
+    with open(tmp, "wb") as f:
+        offsets.tofile(f)
+    os.replace(tmp, idx_path)
+    return idx_path
+
+
+def count_tweets(idx_path: Path) -> int:
+    # Başlık ve son kayıttaki dosya sonu işaretçisi sayılmaz
+    return max(idx_path.stat().st_size // OFFSET_SIZE - INDEX_HEADER - 1, 0)
+
+
+def get_tweet(path: Path, idx_path: Path, index: int) -> str:
+    """Tüm dosyayı okumadan sadece istenen satırı döndürür."""
+    bounds = array("q")
+    with open(idx_path, "rb") as f:
+        f.seek((INDEX_HEADER + index) * OFFSET_SIZE)
+        bounds.fromfile(f, 2)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[bounds[0]:bounds[1]].decode("utf-8").strip()
 
 
 def parse_hours(lines):
@@ -69,30 +194,47 @@ def parse_hours(lines):
     return hours
 
 
-def is_now_within_window(now_tz: datetime, hours_hm, window_seconds: int) -> bool:
-    """
-    Şu an, planlı saatlerden herhangi birine +/- window_seconds içinde mi?
-    Gecikmeli tetiklenmeler için 'bugün' ve 'dün' saatlerini kontrol ediyoruz.
-    """
-    if not hours_hm:
-        return False
+MINUTES_PER_DAY = 24 * 60
 
-    for (h, m) in hours_hm:
-        # bugün
-        today_target = now_tz.replace(hour=h, minute=m, second=0, microsecond=0)
-        # dün
-        yesterday_target = (today_target - timedelta(days=1))
-        # yarın (çok nadiren gerekli olabilir ama güvenlik için ekleyelim)
-        tomorrow_target = (today_target + timedelta(days=1))
 
-        for target in (yesterday_target, today_target, tomorrow_target):
-            diff = abs((now_tz - target).total_seconds())
-            if diff <= window_seconds:
-                return True
-    return False
+def schedule_minutes(hours_hm):
+    """(saat, dakika) listesini sıralı gün-içi dakika listesine çevirir (bisect için)."""
+    return sorted({h * 60 + m for (h, m) in hours_hm})
 
 
-def build_api():
+def due_slots(now_tz: datetime, sched_minutes, window_seconds: int, last_slot=None):
+    """
+    Zamanı gelmiş ama henüz karşılanmamış planlı saatleri epoch dakika olarak (eskiden yeniye) döndürür.
+    Son karşılanan slot bilinmiyorsa sadece şu anın +/- window_seconds çevresine bakılır;
+    biliniyorsa runner'ın kaçırdığı (en fazla son 24 saat) slotlar da dahil edilir.
+    """
+    if not sched_minutes:
+        return []
+
+    now_m = now_tz.timestamp() / 60
+    window_m = window_seconds / 60
+    hi = now_m + window_m
+    lo = now_m - window_m if last_slot is None else max(last_slot, now_m - MINUTES_PER_DAY)
+
+    # Aralığın değdiği her yerel gün için gün-içi dakikalarda bisect (gece yarısı sarması dahil)
+    day = datetime.fromtimestamp(lo * 60, now_tz.tzinfo).date()
+    last_day = datetime.fromtimestamp(hi * 60, now_tz.tzinfo).date()
+    slots = []
+    while day <= last_day:
+        base = int(datetime(day.year, day.month, day.day, tzinfo=now_tz.tzinfo).timestamp()) // 60
+        i = bisect_left(sched_minutes, lo - base)
+        j = bisect_right(sched_minutes, hi - base)
+        slots.extend(base + m for m in sched_minutes[i:j])
+        day += timedelta(days=1)
+
+    if last_slot is not None:
+        slots = [m for m in slots if m > last_slot]
+    return slots
+
+
+@lru_cache(maxsize=1)
+def twitter_credentials():
+    """Twitter anahtarlarını ortamdan bir kez okur ve doğrular."""
     ck = os.getenv("TW_CONSUMER_KEY")
     cs = os.getenv("TW_CONSUMER_SECRET")
     at = os.getenv("TW_ACCESS_TOKEN")
@@ -103,103 +245,156 @@ def build_api():
             "Twitter anahtarları eksik. TW_CONSUMER_KEY / TW_CONSUMER_SECRET / "
             "TW_ACCESS_TOKEN / TW_ACCESS_TOKEN_SECRET ortam değişkenlerini tanımlayın."
         )
+    return ck, cs, at, ats
 
-    auth = tweepy.OAuth1UserHandler(ck, cs, at, ats)
-    return tweepy.API(auth)
 
+@lru_cache(maxsize=1)
+def get_v2_client():
+    # Aynı süreçte tekrar çağrılırsa (retry vb.) aynı oturum yeniden kullanılır.
+    # tweepy (requests, oauthlib, urllib3...) ağırdır; sadece gerçekten paylaşım yapılacaksa yüklenir.
+    import tweepy
 
-def main():
+    ck, cs, at, ats = twitter_credentials()
+    return tweepy.Client(
+        consumer_key=ck,
+        consumer_secret=cs,
+        access_token=at,
+        access_token_secret=ats,
+    )
+
+
+def main(persist_index: bool = False):
     # Ortam değişkenleri
     DRY_RUN = env_bool("DRY_RUN", default=False)
     FORCE_POST_NOW = env_bool("FORCE_POST_NOW", default=False)
     WINDOW_SECONDS = int(os.getenv("WINDOW_SECONDS", "180"))
+    MAX_BATCH = max(int(os.getenv("MAX_BATCH", "3")), 1)
+    BATCH_DELAY_SECONDS = float(os.getenv("BATCH_DELAY_SECONDS", "3"))
 
     now = datetime.now(TZ)
     print(f"Now (Europe/Istanbul): {now.isoformat()}")
 
-    # Verileri yükle
-    tweets = load_lines(TWEETS_PATH)
-    hours_hm = parse_hours(load_lines(HOURS_PATH))
+    # Verileri yükle (tweets.txt indeksi sadece paylaşım yapılacaksa, aşağıda)
+    sched_minutes = load_cached(HOURS_PATH, lambda p: schedule_minutes(parse_hours(load_lines(p))))
 
     state = load_state()
-    last_posted_index = int(state.get("last_posted_index", -1))
-    last_posted_iso = state.get("last_posted_iso")
-
-    # Sıradaki index = en son atılan + 1
-    next_index = last_posted_index + 1
-
-    # Eğer tweet listesi biterse başa dön (sonsuz döngü için)
-    if not tweets:
-        print("Hiç tweet yok (data/tweets.txt boş). Çıkılıyor.")
-        return
-
-    if next_index >= len(tweets):
-        print(f"next_index {next_index} tweet sayısını ({len(tweets)}) aştı, başa sarılıyor.")
-        next_index = 0
+    next_index = int(state.get("next_index", 0))
 
-    # Şimdi gönderim zamanı mı?
-    should_post = FORCE_POST_NOW or is_now_within_window(now, hours_hm, WINDOW_SECONDS)
+    # Şimdi gönderim zamanı mı? Kaçırılan slotlar varsa hepsi (en fazla MAX_BATCH) bu çalıştırmada atılır.
+    if FORCE_POST_NOW:
+        batch = [None]
+    else:
+        due = due_slots(now, sched_minutes, WINDOW_SECONDS, state.get("last_slot_epoch_min"))
+        # En yeni MAX_BATCH slot atılır; daha eskileri bir sonraki slot kaydedilince atlanmış olur
+        batch = due[-MAX_BATCH:]
 
     # Durumu logla
     print(f"FORCE_POST_NOW={FORCE_POST_NOW} | DRY_RUN={DRY_RUN} | WINDOW_SECONDS={WINDOW_SECONDS}")
-    print(f"last_posted_index={last_posted_index} | next_index={next_index}")
+    print(f"last_posted_iso={state.get('last_posted_iso')} | next_index={next_index}")
     if not FORCE_POST_NOW:
-        print(f"Schedule matched? {'YES' if should_post else 'NO'}")
+        print(f"Schedule matched? {'YES' if batch else 'NO'} (due slots: {len(due)}, batch: {len(batch)})")
 
-    if not should_post:
+    if not batch:
         print("Current time not in schedule. Exiting.")
         return
 
-    tweet_text = tweets[next_index]
-    print(f"Candidate tweet #{next_index}: {tweet_text[:80]}{'…' if len(tweet_text) > 80 else ''}")
+    if not FORCE_POST_NOW and already_posted_this_minute(state, now):
+        print("Bu dakika içinde zaten paylaşım yapıldı. Exiting.")
+        return
+
+    # İndeks GitHub Actions'ta her checkout'ta yeniden kurulur; planlı olmayan tick'ler bu maliyeti ödemez
+    # Geçerli indeks varsa sadece gereken satır okunur. Taze checkout'ta (Actions) indeks kurmak
+    # tüm dosyayı okuyup bir de yazmak demek; orada tek geçişlik düz okuma daha ucuz.
+    # Süreç açık kalıyorsa (LOOP_SECONDS) indeks kurulur/tazelenir ve sonraki tick'lerde kullanılır.
+    # Önbelleğe alınmaz: sayı .idx dosyasına da bağlı; başlık kontrolü zaten ucuz.
+    tweets_key = source_key(TWEETS_PATH)
+    if persist_index or read_index_key(TWEETS_INDEX_PATH) == tweets_key:
+        tweets_idx = build_index(TWEETS_PATH, TWEETS_INDEX_PATH, tweets_key)
+        tweet_count = count_tweets(tweets_idx)
+
+        def tweet_at(index):
+            return get_tweet(TWEETS_PATH, tweets_idx, index)
+    else:
+        tweets = load_lines(TWEETS_PATH)
+        tweet_count = len(tweets)
+        tweet_at = tweets.__getitem__
 
-    if DRY_RUN:
-        print("[DRY_RUN] Tweet atılacak (simülasyon):", tweet_text[:80] + ("…" if len(tweet_text) > 80 else ""))
-        # Dry-run’da da ilerlemek isteyebilirsiniz; pratikte üretime geçmeden akışı test etmeyi kolaylaştırır.
-        state["last_posted_index"] = next_index
-        state["last_posted_iso"] = now.isoformat()
-        save_state(state)
-        print(f"[DRY_RUN] last_posted_index -> {next_index} olarak güncellendi.")
+    # Eğer tweet listesi biterse başa dön (sonsuz döngü için)
+    if not tweet_count:
+        print("Hiç tweet yok (data/tweets.txt boş). Çıkılıyor.")
         return
 
-    # Gerçek gönderim
+    if next_index >= tweet_count:
+        print(f"next_index {next_index} tweet sayısını ({tweet_count}) aştı, başa sarılıyor.")
+        next_index = 0
+
+    if not DRY_RUN:
+        import tweepy
+
+    posted = 0
     try:
-        api = build_api()
-        status = api.update_status(status=tweet_text)
-        tweet_id = getattr(status, "id", None)
-        print(f"Tweet gönderildi. ID: {tweet_id}")
-
-        # Başarıyla gönderildiyse state'i ilerlet
-        state["last_posted_index"] = next_index
-        state["last_posted_iso"] = now.isoformat()
-        save_state(state)
-        print(f"State kaydedildi: last_posted_index={next_index}")
-
-    except tweepy.TweepyException as e:
-        # Bazı Tweepy sürümleri error response’u farklı döndürebilir.
-        msg = getattr(e, "response", None)
-        text = ""
-        if msg is not None and hasattr(msg, "text"):
-            text = msg.text
-        else:
-            text = str(e)
-
-        print("Tweepy error:", text)
-
-        # Eğer “duplicate content” hatası geldiyse bu tweet’i atlanabilir.
-        if "duplicate" in text.lower():
-            print("Duplikasyon hatası: Bu içeriği zaten paylaştık, bir sonrakine geçiyoruz.")
-            state["last_posted_index"] = next_index  # bu içeriği artık tüketilmiş say
-            state["last_posted_iso"] = now.isoformat()
-            save_state(state)
-            print(f"State güncellendi (duplicate skip): last_posted_index={next_index}")
-        else:
-            print("Gönderim başarısız. State ilerletilmedi.")
+        for slot in batch:
+            if posted and not DRY_RUN:
+                # Rate limit'e takılmamak için kısa ara; aynı Client oturumu (keep-alive) kullanılır
+                time.sleep(BATCH_DELAY_SECONDS)
+
+            tweet_text = tweet_at(next_index)
+            preview = tweet_text[:80] + ("…" if len(tweet_text) > 80 else "")
+            print(f"Candidate tweet #{next_index}: {preview}")
+
+            if DRY_RUN:
+                # Dry-run’da da ilerlemek isteyebilirsiniz; pratikte üretime geçmeden akışı test etmeyi kolaylaştırır.
+                print("[DRY_RUN] Tweet atılacak (simülasyon):", preview)
+            else:
+                # Gerçek gönderim
+                try:
+                    resp = get_v2_client().create_tweet(text=tweet_text)
+                    tweet_id = (getattr(resp, "data", None) or {}).get("id")
+                    print(f"Tweet gönderildi. ID: {tweet_id}")
+
+                except tweepy.TweepyException as e:
+                    # Bazı Tweepy sürümleri error response’u farklı döndürebilir.
+                    msg = getattr(e, "response", None)
+                    text = ""
+                    if msg is not None and hasattr(msg, "text"):
+                        text = msg.text
+                    else:
+                        text = str(e)
+
+                    print("Tweepy error:", text)
+
+                    # Eğer “duplicate content” hatası geldiyse bu tweet’i atlanabilir.
+                    if "duplicate" not in text.lower():
+                        print("Gönderim başarısız. State bu tweet için ilerletilmedi.")
+                        break
+                    print("Duplikasyon hatası: Bu içeriği zaten paylaştık, bir sonrakine geçiyoruz.")
+
+            # Başarılı (ya da duplicate) => bu içeriği tüketilmiş say.
+            # DRY_RUN slotu karşılanmış saymaz; yoksa gerçek zamanlanmış çalıştırma o slotu atlar.
+            record_post(state, next_index, now, None if DRY_RUN else slot)
+            posted += 1
+            next_index = state["next_index"] % tweet_count
 
     except Exception as e:
         print("Beklenmeyen hata:", repr(e))
-        print("Gönderim başarısız. State ilerletilmedi.")
+        print("Gönderim başarısız. State bu tweet için ilerletilmedi.")
+
+    finally:
+        # Tek seferde kaydet; hata olsa bile o ana kadarki ilerleme korunur
+        if posted:
+            save_state(state)
+            print(f"{'[DRY_RUN] ' if DRY_RUN else ''}State kaydedildi: {posted} tweet, next_index={state['next_index']}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # LOOP_SECONDS > 0 ise süreç açık kalır ve main() bu aralıkla tekrar çalışır (cron yerine)
+    loop_seconds = int(os.getenv("LOOP_SECONDS", "0"))
+    if loop_seconds <= 0:
+        main()
+    while loop_seconds > 0:
+        try:
+            main(persist_index=True)
+        except Exception as e:
+            # Döngü modunda tek bir tick'in hatası (ör. hours.txt düzenlenirken) süreci öldürmesin
+            print("Beklenmeyen hata (döngü devam ediyor):", repr(e))
+        time.sleep(loop_seconds)
\ No newline at end of file